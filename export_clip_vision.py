@@ -0,0 +1,54 @@
+"""Export CLIP's vision tower to ONNX and build the TensorRT engine used by main.py"""
+import shutil
+import subprocess
+import torch
+from transformers import CLIPModel
+
+ONNX_PATH = "clip_vision.onnx"
+ENGINE_PATH = "clip_vision.plan"  # CLIP_VISION_ENGINE in main.py
+IMAGE_SIZE = 224  # CLIP ViT-B/32 input resolution
+MAX_BATCH_SIZE = 32  # BATCH_SIZE in main.py
+
+
+class CLIPVisionEncoder(torch.nn.Module):
+    """Vision tower plus projection, i.e. CLIPModel.get_image_features"""
+
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.vision_model = model.vision_model
+        self.visual_projection = model.visual_projection
+
+    def forward(self, pixel_values):
+        pooled_output = self.vision_model(pixel_values=pixel_values).pooler_output
+        return self.visual_projection(pooled_output)
+
+
+if __name__ == "__main__":
+    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").eval()
+    dummy_input = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+
+    # Only the batch dimension is dynamic; the image shape is fixed
+    torch.onnx.export(
+        CLIPVisionEncoder(model),
+        dummy_input,
+        ONNX_PATH,
+        input_names=["pixel_values"],
+        output_names=["image_embeds"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+        opset_version=17
+    )
+
+    shape = f"3x{IMAGE_SIZE}x{IMAGE_SIZE}"
+    command = [
+        "trtexec",
+        f"--onnx={ONNX_PATH}",
+        "--fp16",
+        f"--minShapes=pixel_values:1x{shape}",
+        f"--optShapes=pixel_values:{MAX_BATCH_SIZE}x{shape}",
+        f"--maxShapes=pixel_values:{MAX_BATCH_SIZE}x{shape}",
+        f"--saveEngine={ENGINE_PATH}"
+    ]
+    if shutil.which("trtexec"):
+        subprocess.run(command, check=True)
+    else:
+        print("trtexec not found; build the engine with:\n" + " ".join(command))
@@ -1,97 +1,277 @@
 import io
 import os
+import asyncio
 import json
+import logging
 import uuid
+import threading
+from contextlib import contextmanager
 import numpy as np
 import faiss
-from fastapi import FastAPI, File, UploadFile, Form, Query
+from fastapi import FastAPI, File, UploadFile, Form, Query, HTTPException
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
 from typing import List
 import torch
+import torch.nn.functional as F
 from transformers import CLIPModel, CLIPProcessor, AutoImageProcessor, AutoModelForObjectDetection
 from ultralytics import YOLO
 import cv2
-import numpy as np
+
+try:
+    import tensorrt as trt
+except ImportError:  # TensorRT is optional; CLIP falls back to PyTorch
+    trt = None
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 
+# Single device shared by YOLOS, CLIP and FAISS
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 yoloprocessor = AutoImageProcessor.from_pretrained("valentinafeve/yolos-fashionpedia")
-yolomodel = AutoModelForObjectDetection.from_pretrained("valentinafeve/yolos-fashionpedia").to(device)
+yolomodel = AutoModelForObjectDetection.from_pretrained("valentinafeve/yolos-fashionpedia")
+yolomodel = yolomodel.to(device, memory_format=torch.channels_last)
+yolo_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
 
-def segment_clothing(image_path):
-    """Detect fashion items using YOLOS Fashionpedia"""
-    # Load and process image
-    image = cv2.imread(image_path)
-    h, w = image.shape[:2]
-    inputs = yoloprocessor(images=image, return_tensors="pt").to(device)
-    
-    # Run inference
-    with torch.no_grad():
-        outputs = yolomodel(**inputs)
-    
-    # Post-process results
-    results = yoloprocessor.post_process_object_detection(
-        outputs,
-        threshold=0.5,
-        target_sizes=[(h, w)]  # Original image dimensions
-    )[0]
-    
-    components = []
-    for score, label, box in zip(results["scores"], results["labels"], results["boxes"]):
-        components.append({
-            "category": yolomodel.config.id2label[label.item()],
-            "confidence": score.item(),
-            "bbox": box.tolist(),  # [xmin, ymin, xmax, ymax]
-            "mask": None
-        })
+# YOLOS preprocessing constants, applied on-device instead of by yoloprocessor
+YOLO_SHORTEST_EDGE = yoloprocessor.size["shortest_edge"]
+YOLO_LONGEST_EDGE = yoloprocessor.size["longest_edge"]
+YOLO_MEAN = torch.tensor(yoloprocessor.image_mean, device=device).view(3, 1, 1)
+YOLO_STD = torch.tensor(yoloprocessor.image_std, device=device).view(3, 1, 1)
+YOLO_MOD_SIZE = 16  # YOLOS patch size; the processor floors both sides to a multiple of it
+
+@contextmanager
+def inference_context():
+    """Disable autograd tracking and autocast matmuls to fp16 on CUDA"""
+    with torch.inference_mode(), \
+            torch.autocast("cuda", dtype=torch.float16, enabled=device.type == "cuda"):
+        yield
+
+@contextmanager
+def on_stream(stream):
+    """Run the enclosed CUDA work on a side stream, ordered after and before the caller's stream"""
+    if stream is None:
+        yield
+        return
+    caller = torch.cuda.current_stream()
+    stream.wait_stream(caller)  # Inputs queued on the caller's stream must land first
+    with torch.cuda.stream(stream):
+        yield
+    # Results are consumed on the caller's stream, so it waits for the side stream
+    done = torch.cuda.Event()
+    done.record(stream)
+    caller.wait_event(done)
+
+def to_device_images(pixel_values: torch.Tensor):
+    """Copy an image batch to the device (via pinned memory on CUDA) in channels_last layout"""
+    if device.type == "cuda":
+        pixel_values = pixel_values.pin_memory()
+    return pixel_values.to(device, non_blocking=True, memory_format=torch.channels_last)
+
+class BatchScheduler:
+    """Coalesce concurrent requests into batched calls of a model function"""
+    
+    def __init__(self, run_batch, max_batch_size: int = 8, max_wait_ms: float = 10):
+        self.run_batch = run_batch  # Maps a list of inputs to a list of outputs
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.worker = None
     
-    return components, image
+    async def submit(self, item):
+        """Queue an item and wait for its result"""
+        if self.worker is None:
+            # Start lazily so the queue binds to the server's event loop
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a first item, then collect more until the batch or window fills
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            items, futures = zip(*batch)
+            try:
+                # Run the model off the event loop so requests keep flowing in
+                results = await asyncio.to_thread(self.run_batch, list(items))
+            except Exception as e:
+                if len(items) == 1:
+                    if not futures[0].done():
+                        futures[0].set_exception(e)
+                else:
+                    # Re-run one at a time so a bad input only fails its own request
+                    await self.run_each(items, futures)
+                continue
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    async def run_each(self, items, futures):
+        """Run items individually, resolving each future with its own result or error"""
+        for item, future in zip(items, futures):
+            try:
+                result = (await asyncio.to_thread(self.run_batch, [item]))[0]
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(result)
+
+def yolo_resized_size(height: int, width: int):
+    """Output size of yoloprocessor's resize (YOLOS get_size_with_aspect_ratio)"""
+    size = YOLO_SHORTEST_EDGE
+    raw_size = None
+    if max(height, width) / min(height, width) * size > YOLO_LONGEST_EDGE:
+        raw_size = YOLO_LONGEST_EDGE * min(height, width) / max(height, width)
+        size = int(round(raw_size))
+    
+    if width < height:
+        ow = size
+        oh = int((raw_size if raw_size is not None else size) * height / width)
+    elif (height <= width and height == size) or (width <= height and width == size):
+        oh, ow = height, width
+    else:
+        oh = size
+        ow = int((raw_size if raw_size is not None else size) * width / height)
+    
+    return oh - oh % YOLO_MOD_SIZE, ow - ow % YOLO_MOD_SIZE
+
+def preprocess_yolo(image: np.ndarray):
+    """Resize and normalize a decoded BGR image for YOLOS on the device"""
+    size = yolo_resized_size(*image.shape[:2])
+    
+    pixels = torch.from_numpy(image)
+    if device.type == "cuda":
+        pixels = pixels.pin_memory()
+    pixels = pixels.to(device, non_blocking=True).permute(2, 0, 1).flip(0)  # HWC BGR -> CHW RGB
+    pixels = pixels.float() * yoloprocessor.rescale_factor
+    pixels = F.interpolate(pixels[None], size=size, mode="bilinear", antialias=True)[0]
+    return (pixels - YOLO_MEAN) / YOLO_STD
+
+def detect_clothing_batch(images: List[np.ndarray]):
+    """Detect fashion items in a batch of images, one YOLOS forward per input shape"""
+    # Keep YOLOS on its own stream so it can overlap with CLIP work
+    with on_stream(yolo_stream):
+        pixel_values = [preprocess_yolo(image) for image in images]
+        
+        # YOLOS has no pixel mask, so padding would change its predictions;
+        # only images with the same resized shape share a forward pass
+        groups = {}
+        for i, p in enumerate(pixel_values):
+            groups.setdefault(tuple(p.shape), []).append(i)
+        
+        detections = [None] * len(images)
+        for group in groups.values():
+            batch = torch.stack([pixel_values[i] for i in group])
+            batch = batch.contiguous(memory_format=torch.channels_last)
+            
+            # Run inference
+            with inference_context():
+                outputs = yolomodel(pixel_values=batch)
+            
+            # Post-process in fp32 so box coordinates keep full precision
+            outputs.logits = outputs.logits.float()
+            outputs.pred_boxes = outputs.pred_boxes.float()
+            
+            # Post-process results against each image's original dimensions
+            batch_results = yoloprocessor.post_process_object_detection(
+                outputs,
+                threshold=0.5,
+                target_sizes=torch.tensor([images[i].shape[:2] for i in group], device=device)
+            )
+            
+            # Convert each image's detections to NumPy once instead of per box
+            for i, results in zip(group, batch_results):
+                detections[i] = {
+                    "scores": results["scores"].cpu().numpy(),
+                    "labels": results["labels"].cpu().numpy(),
+                    "boxes": results["boxes"].cpu().numpy().astype(int),  # [xmin, ymin, xmax, ymax]
+                }
+        
+        return detections
+
+yolo_scheduler = BatchScheduler(detect_clothing_batch)
+
+# Garment details that are not standalone clothing items
+EXCLUDED_CATEGORIES = {
+    'headband, head covering, hair accessory','hood', 'collar', 'lapel', 'epaulette', 'sleeve',
+    'pocket', 'neckline', 'buckle', 'zipper', 'applique',
+    'bead', 'bow', 'flower', 'fringe', 'ribbon',
+    'rivet', 'ruffle', 'sequin', 'tassel'
+}
+
+# Label names indexable by id, and which ids are excluded, frozen once at load
+ID2LABEL = tuple(yolomodel.config.id2label[i] for i in range(len(yolomodel.config.id2label)))
+EXCLUDED_MASK = np.fromiter((name in EXCLUDED_CATEGORIES for name in ID2LABEL), dtype=bool)
+EXCLUDED_MASK.flags.writeable = False
+
+async def segment_clothing(image: np.ndarray):
+    """Detect fashion items using YOLOS Fashionpedia"""
+    # Queue the decoded image for batched detection
+    return await yolo_scheduler.submit(image)
 
 
 @app.post("/analyze-outfit")
 async def analyze_outfit(image: UploadFile = File(...)):
-    # Save temporary file
-    temp_path = f"segments/outfits/temp_{uuid.uuid4()}.jpg"
-    with open(temp_path, "wb") as f:
-        f.write(await image.read())
+    # Decode the upload in memory instead of round-tripping through a temp file
+    data = await image.read()
+    base_image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if base_image is None:
+        # Reject undecodable uploads before they reach the shared YOLOS batch
+        raise HTTPException(status_code=400, detail="Could not decode image")
     
     # Get components using YOLOS
-    components, base_image = segment_clothing(temp_path)
+    detections = await segment_clothing(base_image)
+    scores = detections["scores"]
+    labels = detections["labels"]
+    boxes = detections["boxes"]
     
     output = []
-    excluded_categories = {
-            'headband, head covering, hair accessory','hood', 'collar', 'lapel', 'epaulette', 'sleeve',
-            'pocket', 'neckline', 'buckle', 'zipper', 'applique',
-            'bead', 'bow', 'flower', 'fringe', 'ribbon',
-            'rivet', 'ruffle', 'sequin', 'tassel'
-        }
     category_tracker = {}  # Track highest confidence per category
-        
-    for comp in components:
+    
+    # Filter confident, standalone items in one pass and only visit survivors
+    keep = (scores >= 0.75) & ~EXCLUDED_MASK[labels]
+    for i in np.flatnonzero(keep):
+        current_category = ID2LABEL[labels[i]]
+        current_conf = float(scores[i])
+
+        # Update if category not seen or higher confidence than existing
+        if current_category not in category_tracker or \
+            current_conf > category_tracker[current_category]['confidence']:
+            
+            # Crop segment; it is only written once the winner is known
+            x1, y1, x2, y2 = boxes[i]
+            cropped = base_image[y1:y2, x1:x2]
 
-        if comp['confidence'] >= 0.75 and comp['category'] not in excluded_categories:
-            current_category = comp['category']
-            current_conf = comp['confidence']
+            # Update tracker with complete component data
+            category_tracker[current_category] = {
+                "category": current_category,
+                "confidence": current_conf,
+                "crop": cropped
+            }
 
-            # Update if category not seen or higher confidence than existing
-            if current_category not in category_tracker or \
-                current_conf > category_tracker[current_category]['confidence']:
-                
-                # Crop and save segment
-                x1, y1, x2, y2 = map(int, comp['bbox'])
-                cropped = base_image[y1:y2, x1:x2]
-                seg_path = f"segments/{uuid.uuid4()}.jpg"
-                cv2.imwrite(seg_path, cropped)
-
-                # Update tracker with complete component data
-                category_tracker[current_category] = {
-                    "category": current_category,
-                    "confidence": float(current_conf),
-                    "segment_path": seg_path
-                }
+    # Save the winning segment per category off the event loop
+    for comp in category_tracker.values():
+        comp["segment_path"] = f"segments/{uuid.uuid4()}.jpg"
+    await asyncio.gather(*[
+        asyncio.to_thread(cv2.imwrite, comp["segment_path"], comp.pop("crop"))
+        for comp in category_tracker.values()
+    ])
 
     # Convert tracker dict values to output list
     output = list(category_tracker.values())
@@ -104,22 +284,198 @@ SEG_DIR = "segments"
 COMMENTS_FILE = "image_comments.json"
 EMBEDDING_DIM = 512  # CLIP base model dimension
 INDEX_PATH = "faiss_index.index"
+BATCH_SIZE = 32  # Image-text pairs per CLIP forward pass when re-indexing
+EMB_CACHE_SUFFIX = ".emb.npy"  # Cached image embedding stored next to each image
+PERSIST_DELAY = 0.5  # Seconds to coalesce index/metadata writes after a change
+PERSIST_SHUTDOWN_TIMEOUT = 10  # Seconds to wait for pending writes when stopping
+CLIP_VISION_ENGINE = "clip_vision.plan"  # Built by export_clip_vision.py
 
 # Create directories if they don't exist
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
+# Load comments once; endpoints update this dict and persistence writes it back
+comments_data = {}
+if os.path.exists(COMMENTS_FILE):
+    with open(COMMENTS_FILE) as f:
+        comments_data = json.load(f)
+
 # Load CLIP model and processor
-device = "cuda" if torch.cuda.is_available() else "cpu"
 model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
+model.vision_model.to(memory_format=torch.channels_last)
+# Separate streams let image and text batches execute concurrently
+clip_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+clip_text_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
 processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
 
-# Initialize FAISS index and metadata store
-index = faiss.IndexFlatL2(EMBEDDING_DIM)
-metadata = []
+class TRTVisionEncoder:
+    """CLIP vision tower + projection compiled to a TensorRT engine"""
+    
+    def __init__(self, engine_path: str):
+        self.runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+        with open(engine_path, "rb") as f:
+            self.engine = self.runtime.deserialize_cuda_engine(f.read())
+        if self.engine is None:
+            # Engines only load on the TensorRT version and GPU they were built for
+            raise RuntimeError(f"Could not deserialize TensorRT engine {engine_path}")
+        self.context = self.engine.create_execution_context()
+        self.lock = threading.Lock()  # Execution contexts are not thread-safe
+    
+    def __call__(self, pixel_values: torch.Tensor):
+        """Same output as model.get_image_features(pixel_values=...)"""
+        pixel_values = pixel_values.float().contiguous()  # Engine expects fp32 NCHW
+        image_embeds = torch.empty(
+            (pixel_values.shape[0], EMBEDDING_DIM), dtype=torch.float32, device=pixel_values.device
+        )
+        with self.lock:
+            self.context.set_input_shape("pixel_values", tuple(pixel_values.shape))
+            self.context.set_tensor_address("pixel_values", pixel_values.data_ptr())
+            self.context.set_tensor_address("image_embeds", image_embeds.data_ptr())
+            if not self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream):
+                # image_embeds would be uninitialized memory, so never return it
+                raise RuntimeError(
+                    f"TensorRT failed to run CLIP vision engine on input {tuple(pixel_values.shape)}"
+                )
+        return image_embeds
+
+# Use the TensorRT vision engine when it has been built, else eager PyTorch
+image_encoder = None
+if trt is not None and device.type == "cuda" and os.path.exists(CLIP_VISION_ENGINE):
+    try:
+        image_encoder = TRTVisionEncoder(CLIP_VISION_ENGINE)
+    except RuntimeError:
+        logger.exception("Falling back to PyTorch for the CLIP vision tower")
+
+# Keep the FAISS index on GPU when CUDA and faiss-gpu are available
+gpu_resources = None
+if device.type == "cuda" and hasattr(faiss, "StandardGpuResources"):
+    gpu_resources = faiss.StandardGpuResources()
+
+def to_device_index(cpu_index):
+    """Move a CPU FAISS index onto the GPU if one is available"""
+    if gpu_resources is None:
+        return cpu_index
+    options = faiss.GpuClonerOptions()
+    options.useFloat16 = True  # Store vectors as fp16 on the GPU
+    return faiss.index_cpu_to_gpu(gpu_resources, device.index or 0, cpu_index, options)
+
+def new_vector_storage():
+    """Create an empty inner-product (cosine) index with fp16 vector storage"""
+    if gpu_resources is None:
+        return faiss.IndexScalarQuantizer(
+            EMBEDDING_DIM, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+        )
+    # Scalar quantizers have no flat GPU version; the GPU clone stores fp16 instead
+    return faiss.IndexFlatIP(EMBEDDING_DIM)
+
+def new_cpu_index():
+    """Create an empty CPU index addressed by stable item ids"""
+    return faiss.IndexIDMap2(new_vector_storage())
+
+def new_index():
+    """Create an empty FAISS index addressed by stable item ids"""
+    return to_device_index(new_cpu_index())
+
+def is_current_layout(stored_index):
+    """Whether a persisted index matches the layout created by new_cpu_index"""
+    if not isinstance(stored_index, faiss.IndexIDMap2):
+        return False
+    stored = faiss.downcast_index(stored_index.index)
+    expected = new_vector_storage()
+    return type(stored) is type(expected) and stored.metric_type == expected.metric_type
+
+def remove_from_index(item_id: int):
+    """Remove a single item's embedding from the FAISS index"""
+    global index
+    ids = np.array([item_id], dtype='int64')
+    if gpu_resources is None:
+        index.remove_ids(ids)
+        return
+    # GPU flat indexes don't support removal, so round-trip through a CPU copy
+    cpu_index = faiss.index_gpu_to_cpu(index)
+    cpu_index.remove_ids(ids)
+    index = to_device_index(cpu_index)
+
+# Initialize FAISS index and metadata store (item id -> metadata)
+index = new_index()
+metadata = {}
 if os.path.exists(INDEX_PATH):
-    index = faiss.read_index(INDEX_PATH)
+    stored_index = faiss.read_index(INDEX_PATH)
     with open("metadata.json", "r") as f:
-        metadata = json.load(f)
+        stored_metadata = json.load(f)
+    
+    if isinstance(stored_metadata, list):
+        # Legacy layout: rows are positional, so the row number becomes the id
+        metadata = dict(enumerate(stored_metadata))
+    else:
+        metadata = {int(item_id): item for item_id, item in stored_metadata.items()}
+    
+    if is_current_layout(stored_index):
+        index = to_device_index(stored_index)
+    elif metadata:
+        # Older or differently stored index: copy the vectors over, normalized for cosine search
+        ids = np.array(list(metadata), dtype='int64')
+        vectors = np.vstack([stored_index.reconstruct(int(i)) for i in ids])
+        faiss.normalize_L2(vectors)
+        index.add_with_ids(vectors, ids)
+
+def find_item_id(filename: str):
+    """Return the id of the indexed item stored under filename, if any"""
+    for item_id, item in metadata.items():
+        if item['filename'] == filename:
+            return item_id
+    return None
+
+def snapshot_state():
+    """Serialize the index, metadata and comments in memory so they can be written off-loop"""
+    cpu_index = index if gpu_resources is None else faiss.index_gpu_to_cpu(index)
+    return (
+        faiss.serialize_index(cpu_index),
+        json.dumps(metadata, indent=2),
+        json.dumps(comments_data, indent=2)
+    )
+
+def write_state(index_bytes, metadata_json: str, comments_json: str):
+    """Write a snapshot taken by snapshot_state to disk"""
+    with open(INDEX_PATH, "wb") as f:
+        f.write(index_bytes.tobytes())
+    with open("metadata.json", "w") as f:
+        f.write(metadata_json)
+    with open(COMMENTS_FILE, "w") as f:
+        f.write(comments_json)
+
+# Pending background persistence (see schedule_persist)
+persist_dirty = False
+persist_task = None
+
+def schedule_persist():
+    """Mark state dirty and make sure a single trailing write is pending"""
+    global persist_dirty, persist_task
+    persist_dirty = True
+    if persist_task is None or persist_task.done():
+        persist_task = asyncio.create_task(persist_later())
+
+async def persist_later():
+    """Write state once changes settle, coalescing every change in the window"""
+    global persist_dirty
+    while persist_dirty:
+        await asyncio.sleep(PERSIST_DELAY)
+        persist_dirty = False
+        try:
+            await asyncio.to_thread(write_state, *snapshot_state())
+        except Exception:
+            # Keep the changes pending so the next pass retries the write
+            logger.exception("Failed to persist index, metadata and comments; retrying")
+            persist_dirty = True
+
+@app.on_event("shutdown")
+async def flush_persist():
+    """Flush pending writes when the server stops (e.g. on SIGTERM)"""
+    if persist_task is not None:
+        # The pending task keeps writing until nothing is dirty; don't hang if writes keep failing
+        try:
+            await asyncio.wait_for(persist_task, timeout=PERSIST_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Gave up persisting pending changes on shutdown")
 
 # Serve images statically
 app.mount("/images", StaticFiles(directory=IMAGE_DIR), name="images")
@@ -127,24 +483,102 @@ app.mount("/images", StaticFiles(directory=IMAGE_DIR), name="images")
 # Serve segments statically
 app.mount("/segments", StaticFiles(directory=SEG_DIR), name="segments")
 
-def process_image_text_pair(image_path: str, text: str):
-    """Process image and text to generate combined embedding"""
-    image = Image.open(image_path)
+def image_emb_cache_path(image_path: str):
+    """Path of the cached image embedding stored next to the image file"""
+    return image_path + EMB_CACHE_SUFFIX
+
+def has_fresh_cache(image_path: str):
+    """Whether a cached embedding exists and is not older than its image"""
+    cache_path = image_emb_cache_path(image_path)
+    # An image replaced on disk (e.g. dropped into images/ before a rebuild) is newer than its cache
+    return (os.path.exists(cache_path) and
+            os.path.getmtime(cache_path) >= os.path.getmtime(image_path))
+
+def handoff(tensor: torch.Tensor):
+    """Mark a tensor made on a CLIP stream as in use by the current stream before returning it"""
+    if device.type == "cuda":
+        # Stops the allocator from reusing its memory while this stream may still read it
+        tensor.record_stream(torch.cuda.current_stream())
+    return tensor
+
+def encode_images(images: List[Image.Image]):
+    """Encode images into normalized CLIP image embeddings (vision tower only)"""
     inputs = processor(
-        text=[text], 
-        images=image,
-        return_tensors="pt", 
+        images=images,
+        return_tensors="pt"
+    )
+    
+    with on_stream(clip_stream), inference_context():
+        pixel_values = to_device_images(inputs["pixel_values"])
+        if image_encoder is not None:
+            image_emb = image_encoder(pixel_values)
+        else:
+            image_emb = model.get_image_features(pixel_values=pixel_values)
+        image_emb = F.normalize(image_emb.float(), dim=-1)
+    return handoff(image_emb)
+
+def get_image_embs(image_paths: List[str]):
+    """Load normalized image embeddings from the on-disk cache, encoding any misses"""
+    embeddings = np.empty((len(image_paths), EMBEDDING_DIM), dtype='float32')
+    missing = []
+    for i, image_path in enumerate(image_paths):
+        if has_fresh_cache(image_path):
+            embeddings[i] = np.load(image_emb_cache_path(image_path))
+        else:
+            missing.append(i)
+    
+    # Only run the vision encoder for images without a cached embedding
+    for start in range(0, len(missing), BATCH_SIZE):
+        batch = missing[start:start + BATCH_SIZE]
+        image_emb = encode_images([Image.open(image_paths[i]) for i in batch])
+        image_emb = image_emb.cpu().numpy().astype('float16')
+        
+        for i, emb in zip(batch, image_emb):
+            np.save(image_emb_cache_path(image_paths[i]), emb)
+            embeddings[i] = emb
+    
+    return embeddings
+
+def get_text_embs(texts: List[str]):
+    """Encode texts into normalized CLIP text embeddings (text tower only)"""
+    inputs = processor(
+        text=texts,
+        return_tensors="pt",
         padding=True
     ).to(device)
     
-    with torch.no_grad():
-        features = model(**inputs)
-        image_emb = features.image_embeds.cpu().numpy()[0]
-        text_emb = features.text_embeds.cpu().numpy()[0]
-    
-    combined_emb = (image_emb / np.linalg.norm(image_emb) + 
-                   text_emb / np.linalg.norm(text_emb)) / 2
-    return combined_emb.astype('float32')
+    with on_stream(clip_text_stream), inference_context():
+        text_emb = F.normalize(model.get_text_features(**inputs).float(), dim=-1)
+    return handoff(text_emb)
+
+def process_image_text_pair(image_path: str, text: str):
+    """Process image and text to generate combined embedding"""
+    return process_image_text_batch([image_path], [text])[0]
+
+def process_image_text_batch(image_paths: List[str], texts: List[str]):
+    """Process image and text pairs in batches to generate combined embeddings"""
+    batches = []
+    for start in range(0, len(image_paths), BATCH_SIZE):
+        image_emb = torch.from_numpy(get_image_embs(image_paths[start:start + BATCH_SIZE]))
+        combined_emb = image_emb.to(device)
+        
+        # Skip the text encoder for items without any text
+        batch_texts = texts[start:start + BATCH_SIZE]
+        with_text = [i for i, text in enumerate(batch_texts) if text and text.strip()]
+        if with_text:
+            combined_emb[with_text] += get_text_embs([batch_texts[i] for i in with_text])
+        
+        # Unit-normalize the combination on-device so inner product is cosine similarity
+        batches.append(F.normalize(combined_emb, dim=-1))
+
+    if not batches:
+        return np.empty((0, EMBEDDING_DIM), dtype='float32')
+    # Concatenate on-device and copy to host once
+    return torch.cat(batches, dim=0).cpu().numpy().astype('float32', copy=False)
+
+# Coalesce concurrent query encodes into batched CLIP forwards
+clip_image_scheduler = BatchScheduler(encode_images, max_batch_size=BATCH_SIZE)
+clip_text_scheduler = BatchScheduler(get_text_embs, max_batch_size=BATCH_SIZE)
 
 @app.post("/add-item")
 async def add_item(
@@ -158,39 +592,41 @@ async def add_item(
     with open(image_path, "wb") as f:
         f.write(await image.read())
     
+    # Drop any cached embedding from a previous upload with the same name
+    cache_path = image_emb_cache_path(image_path)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    
     # Process tags
     tag_list = [t.strip() for t in tags.split(",") if t.strip()]
     
     # Update comments data with new structure
-    comments_data = {}
-    if os.path.exists(COMMENTS_FILE):
-        with open(COMMENTS_FILE) as f:
-            comments_data = json.load(f)
-    
     comments_data[filename] = {
         "comment": comment,
         "tags": tag_list
     }
     
-    with open(COMMENTS_FILE, "w") as f:
-        json.dump(comments_data, f, indent=2)
-    
     # Generate embedding using combined comment + tags
     combined_text = f"{comment} {' '.join(tag_list)}"
-    emb = process_image_text_pair(image_path, combined_text)
-    index.add(np.array([emb]))
+    emb = await asyncio.to_thread(process_image_text_pair, image_path, combined_text)
+    
+    # Re-uploading a filename replaces the existing item under the same id
+    item_id = find_item_id(filename)
+    if item_id is None:
+        item_id = max(metadata, default=-1) + 1
+    else:
+        remove_from_index(item_id)
+    index.add_with_ids(emb[None], np.array([item_id], dtype='int64'))
     
     # Update metadata
-    metadata.append({
+    metadata[item_id] = {
         "filename": filename,
         "comment": comment,
         "tags": tag_list
-    })
+    }
     
-    # Persist changes
-    faiss.write_index(index, INDEX_PATH)
-    with open("metadata.json", "w") as f:
-        json.dump(metadata, f, indent=2)
+    # Persist changes in the background
+    schedule_persist()
     
     return {"message": "Item added successfully"}
 
@@ -199,14 +635,12 @@ async def add_item(
 async def rebuild_index():
     global index, metadata
     # Reset index and metadata
-    index = faiss.IndexFlatL2(EMBEDDING_DIM)
-    metadata = []
+    index = new_index()
+    metadata = {}
     
-    if os.path.exists(COMMENTS_FILE):
-        with open(COMMENTS_FILE) as f:
-            comments_data = json.load(f)
-        
-        embeddings = []
+    if comments_data:
+        image_paths = []
+        texts = []
         new_metadata = []
         
         for filename, data in comments_data.items():
@@ -222,21 +656,22 @@ async def rebuild_index():
             if not os.path.exists(image_path):
                 continue
                 
-            combined_text = f"{comment} {' '.join(tags)}"
-            emb = process_image_text_pair(image_path, combined_text)
-            embeddings.append(emb)
+            image_paths.append(image_path)
+            texts.append(f"{comment} {' '.join(tags)}")
             new_metadata.append({
                 "filename": filename,
                 "comment": comment,
                 "tags": tags
             })
         
-        if embeddings:
-            index.add(np.vstack(embeddings))
-            faiss.write_index(index, INDEX_PATH)
-            with open("metadata.json", "w") as f:
-                json.dump(new_metadata, f, indent=2)
-        metadata = new_metadata
+        if new_metadata:
+            # Encode in batches, then add everything with a single FAISS call
+            embeddings = process_image_text_batch(image_paths, texts)
+            index.add_with_ids(embeddings, np.arange(len(new_metadata), dtype='int64'))
+        metadata = dict(enumerate(new_metadata))
+    
+    # Background persistence is the only writer of the index and metadata files
+    schedule_persist()
     
     return {"message": "Index rebuilt successfully"}
 
@@ -246,48 +681,39 @@ async def search_image(
     image: UploadFile = File(...),
     comment: str = Form(""),
     k: int = Query(3, ge=1, le=50),
-    max_distance: float = Query(0.4, description="Maximum L2 distance threshold")
+    max_distance: float = Query(
+        0.5,
+        description="Maximum squared L2 distance between unit-normalized embeddings "
+                    "(cosine similarity >= 1 - max_distance / 2)"
+    )
 ) -> List[dict]:
     """Search using image + optional text query"""
-    # Process query image
-    img = Image.open(io.BytesIO(await image.read()))
-    
-    if comment:  # Both image and text search
-        inputs = processor(
-            text=[comment], 
-            images=img,
-            return_tensors="pt", 
-            padding=True
-        ).to(device)
-        
-        with torch.no_grad():
-            features = model(**inputs)
-            image_emb = features.image_embeds.cpu().numpy()[0]
-            text_emb = features.text_embeds.cpu().numpy()[0]
-        
-        # Same combination as storage
-        query_emb = (image_emb / np.linalg.norm(image_emb) + 
-                    text_emb / np.linalg.norm(text_emb)) / 2
+    # Process query image; decode now since Image.open is lazy
+    try:
+        img = Image.open(io.BytesIO(await image.read())).convert("RGB")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Could not decode image")
+    
+    if comment.strip():  # Both image and text search, same combination as storage
+        image_emb, text_emb = await asyncio.gather(
+            clip_image_scheduler.submit(img),
+            clip_text_scheduler.submit(comment)
+        )
+        query_emb = image_emb + text_emb
     else:  # Image-only search
-        inputs = processor(
-            images=img,
-            return_tensors="pt"
-        ).to(device)
-        
-        with torch.no_grad():
-            image_emb = model.get_image_features(**inputs).cpu().numpy()[0]
-        
-        # Only use normalized image embedding
-        query_emb = image_emb / np.linalg.norm(image_emb)
+        query_emb = await clip_image_scheduler.submit(img)
+    query_emb = F.normalize(query_emb, dim=-1).cpu().numpy()
     
     query_emb = query_emb.astype('float32').reshape(1, -1)
-    distances, indices = index.search(query_emb, k)
-    print(distances)
+    similarities, indices = index.search(query_emb, k)
+    logger.debug("Search similarities: %s", similarities)
     
+    # For unit vectors ||a - b||^2 = 2 - 2 * <a, b>
+    min_similarity = 1 - max_distance / 2
     results = [
-        metadata[idx]
-        for d, idx in zip(distances[0], indices[0])
-        if d <= max_distance and idx < len(metadata)
+        metadata[int(idx)]
+        for sim, idx in zip(similarities[0], indices[0])
+        if sim >= min_similarity and int(idx) in metadata
     ]
     
     return results
@@ -295,12 +721,6 @@ async def search_image(
 @app.get("/items")
 async def get_all_items():
     """Get all items with image URLs, comments, and tags"""
-    if not os.path.exists(COMMENTS_FILE):
-        return []
-    
-    with open(COMMENTS_FILE, "r") as f:
-        comments_data = json.load(f)
-    
     items = []
     for filename, data in comments_data.items():
         # Verify image actually exists
@@ -331,29 +751,21 @@ async def delete_item(filename: str):
         image_path = os.path.join(IMAGE_DIR, filename)
         if os.path.exists(image_path):
             os.remove(image_path)
+        cache_path = image_emb_cache_path(image_path)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
         
         # Remove from comments data
-        with open(COMMENTS_FILE, "r") as f:
-            comments_data = json.load(f)
         del comments_data[filename]
-        with open(COMMENTS_FILE, "w") as f:
-            json.dump(comments_data, f, indent=2)
         
-        # Remove from metadata and save
-        global metadata
-        metadata = [item for item in metadata if item['filename'] != filename]
-        with open("metadata.json", "w") as f:
-            json.dump(metadata, f, indent=2)
+        # Remove the embedding in place and drop its metadata
+        item_id = find_item_id(filename)
+        if item_id is not None:
+            remove_from_index(item_id)
+            del metadata[item_id]
         
-        # Rebuild index to remove embeddings
-        index.reset()
-        if metadata:
-            embeddings = [process_image_text_pair(
-                os.path.join(IMAGE_DIR, item['filename']),
-                f"{item['comment']} {' '.join(item['tags'])}"
-            ) for item in metadata]
-            index.add(np.array(embeddings))
-            faiss.write_index(index, INDEX_PATH)
+        # Persist changes in the background
+        schedule_persist()
         
         return {"message": "Item deleted successfully"}
     